@@ -1,23 +1,48 @@
 import json
-from powerbi import PowerBI, generate_access_token
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from powerbi import PowerBI, generate_access_token, MAX_ROWS_PER_PUSH, DEFAULT_PBI_TABLE
 from dataiku.exporter import Exporter
 from math import isnan
 from safe_logger import SafeLogger
 
+try:
+    from sys import intern
+except ImportError:
+    def intern(name):
+        # The python 2 builtin rejects unicode, which DSS column names are
+        return name
+
 logger = SafeLogger("power-bi-v2 plugin", forbiden_keys=["ms-oauth_credentials", "password", "client-secret"])
 
 
 class PowerBIExporter(Exporter):
 
     EMPTY_CONNECTION = {"username": None, "password": None, "client-id": None, "client-secret": None}
+    INTEGER_TYPES = ['int', 'bigint', 'tinyint', 'smallint']
+    # A single worker keeps the pushes in row order on the server side,
+    #    while still overlapping the network time with reading the next rows
+    PUSH_WORKERS = 1
+    # Buffers waiting for or being pushed, stays below the Power BI limit of 5 pending push requests per dataset
+    MAX_PENDING_PUSHES = 4
 
     def __init__(self, config, plugin_config):
         logger.info("config={}, plugin_config={}".format(logger.filter_secrets(config), logger.filter_secrets(plugin_config)))
         self.config = config
         self.plugin_config = plugin_config
         self.row_index = 0
-        self.row_buffer = {}
-        self.row_buffer["rows"] = []
+        # Rows accepted by Power BI, pushes never overlap so the single worker and close() can both count them
+        self.pushed_rows = 0
+        self.start_time = None
+        self.row_buffer = None
+        # Full buffers are pushed in the background while the next one is being filled
+        self.executor = ThreadPoolExecutor(max_workers=self.PUSH_WORKERS)
+        self.pending_pushes = deque()
+        self.pending_pushes_slots = threading.BoundedSemaphore(self.MAX_PENDING_PUSHES)
+        # First failed push, every later push is skipped and the error raised again until close()
+        self.push_error = None
 
         self.pbi_dataset = self.config.get("dataset", None)
         if not self.pbi_dataset:
@@ -25,15 +50,18 @@ class PowerBIExporter(Exporter):
         self.pbi_workspace = self.config.get("workspace", None)
         if self.pbi_workspace == "":
             self.pbi_workspace = None
-        self.pbi_table = "dss-data"
-        self.pbi_buffer_size = self.config.get("buffer_size", None)
+        self.pbi_table = DEFAULT_PBI_TABLE
+        self.pbi_buffer_size = self.get_buffer_size_from_config(config)
 
         self.export_method = self.config.get("export_method", None)
+        self.rows_relay_url = self.config.get("rows_relay_url", None)
+        self.wire_format = self.config.get("wire_format", None) if self.rows_relay_url else None
+        self.compress_rows = self.config.get("compress_rows", False)
 
         authentication_method = self.config.get("authentication_method", None)
         if authentication_method == "oauth":
             access_token = self.get_oauth_token_from_config(config)
-            self.pbi = PowerBI(access_token)
+            self.pbi = PowerBI(access_token, wire_format=self.wire_format, rows_relay_url=self.rows_relay_url, compress_rows=self.compress_rows)
             self.pbi_group_id = self.pbi.get_group_id_by_name(self.pbi_workspace)
         elif authentication_method == "credentials":
             basic_connection = self.config.get("basic_connection", self.EMPTY_CONNECTION)
@@ -53,11 +81,21 @@ class PowerBIExporter(Exporter):
                 logger.error("ERROR [-] Error while retrieving your Power BI access token, please check your credentials.")
                 logger.error("ERROR [-] Azure authentication API response:")
                 logger.error(json.dumps(response, indent=4))
-                raise Exception("Authentication error")
+                raise Exception("Authentication error. {}".format(response.get("error_description", "")))
             # Interacting with Power BI API's
-            self.pbi = PowerBI(token)
+            self.pbi = PowerBI(token, wire_format=self.wire_format, rows_relay_url=self.rows_relay_url, compress_rows=self.compress_rows)
             self.pbi_group_id = self.pbi.get_group_id_by_name(self.pbi_workspace)
 
+    @staticmethod
+    def get_buffer_size_from_config(config):
+        buffer_size = config.get("buffer_size", None)
+        buffer_size = int(buffer_size or MAX_ROWS_PER_PUSH)
+        if buffer_size > MAX_ROWS_PER_PUSH:
+            logger.warning("Buffer size {} exceeds the Power BI limit of {} rows per push, using {}".format(
+                buffer_size, MAX_ROWS_PER_PUSH, MAX_ROWS_PER_PUSH
+            ))
+        return max(1, min(buffer_size, MAX_ROWS_PER_PUSH))
+
     def get_oauth_token_from_config(self, config):
         access_token = config.get('powerbi_connection', {}).get('ms-oauth_credentials')
         if access_token is None:
@@ -70,15 +108,24 @@ class PowerBIExporter(Exporter):
         return access_token
 
     def open(self, schema):
+        self.start_time = time.time()
         self.schema = schema
+        # Interned, so that every row dict shares the same key objects.
+        #    The JSON encoder still writes each key for each row, but the memory
+        #    held per key is paid once instead of once per row
+        self.col_names = tuple(intern(column["name"]) for column in schema["columns"])
+        self.integer_col_names = tuple(
+            intern(column["name"]) for column in schema["columns"] if column["type"] in self.INTEGER_TYPES
+        )
         self.pbi.register_formattable_columns(self.schema)
+        self.row_buffer = self.pbi.new_rows_payload()
 
         if self.export_method == "overwrite":
-            datasets = self.pbi.get_dataset_by_name(self.pbi_dataset, pbi_group_id=self.pbi_group_id)
-            if len(datasets) > 0:
-                logger.warning("Emptying dataset {}".format(datasets[0]))
-                self.pbi.empty_dataset(datasets[0], pbi_table=self.pbi_table, pbi_group_id=self.pbi_group_id)
-                self.dsid = datasets[0]
+            dataset_id = self.pbi.get_first_dataset_id_by_name(self.pbi_dataset, pbi_group_id=self.pbi_group_id)
+            if dataset_id is not None:
+                logger.warning("Emptying dataset {}".format(dataset_id))
+                self.pbi.empty_dataset(dataset_id, pbi_table=self.pbi_table, pbi_group_id=self.pbi_group_id)
+                self.dsid = dataset_id
                 logger.info("[+] First emptied Power BI dataset ID for overwrite {}".format(self.dsid))
             else:
                 logger.error("ERROR [-] No existing dataset with name {}".format(self.pbi_dataset))
@@ -86,9 +133,9 @@ class PowerBIExporter(Exporter):
                 raise Exception("Cannot overwrite: no existing dataset with name {}".format(self.pbi_dataset))
 
         elif self.export_method == "append":
-            datasets = self.pbi.get_dataset_by_name(self.pbi_dataset, pbi_group_id=self.pbi_group_id)
-            if len(datasets) > 0:
-                self.dsid = datasets[0]
+            dataset_id = self.pbi.get_first_dataset_id_by_name(self.pbi_dataset, pbi_group_id=self.pbi_group_id)
+            if dataset_id is not None:
+                self.dsid = dataset_id
                 logger.info("[+] Will append to Power BI dataset ID {}".format(self.dsid))
             else:
                 logger.error("ERROR [-] No existing dataset with name {}".format(self.pbi_dataset))
@@ -96,8 +143,8 @@ class PowerBIExporter(Exporter):
                 raise Exception("Cannot overwrite: no existing dataset with name {}".format(self.pbi_dataset))
 
         else:  # new_dataset
-            datasets = self.pbi.get_dataset_by_name(self.pbi_dataset, pbi_group_id=self.pbi_group_id)
-            if len(datasets) > 0:
+            dataset_id = self.pbi.get_first_dataset_id_by_name(self.pbi_dataset, pbi_group_id=self.pbi_group_id)
+            if dataset_id is not None:
                 logger.error("ERROR [-] Dataset with name {} already exists".format(self.pbi_dataset))
                 raise Exception("Dataset '{}' already exists".format(self.pbi_dataset))
             response = self.pbi.create_dataset_from_schema(
@@ -116,35 +163,73 @@ class PowerBIExporter(Exporter):
             logger.info("[+] Created new Power BI dataset ID {}".format(self.dsid))
 
     def write_row(self, row):
-        row_obj = {}
-        for (col, val) in zip(self.schema["columns"], row):
-            if col['type'] in ['int', 'bigint', 'tinyint', 'smallint']:
-                row_obj[col["name"]] = int(val) if val is not None and not isnan(val) else None
-            else:
-                row_obj[col["name"]] = val
-        self.row_buffer["rows"].append(row_obj)
-        if len(self.row_buffer["rows"]) > self.pbi_buffer_size:
-            self.pbi.post_table_row(
-                self.row_buffer["rows"],
-                self.dsid,
-                self.pbi_table,
-                pbi_group_id=self.pbi_group_id
-            )
-            self.row_buffer["rows"] = []
+        row_obj = dict(zip(self.col_names, row))
+        for col_name in self.integer_col_names:
+            val = row_obj[col_name]
+            row_obj[col_name] = int(val) if val is not None and not isnan(val) else None
+        self.row_buffer.append(row_obj)
+        if len(self.row_buffer) >= self.pbi_buffer_size:
+            rows_payload = self.row_buffer
+            self.row_buffer = self.pbi.new_rows_payload()
+            self.submit_rows(rows_payload)
         self.row_index += 1
 
-    def close(self):
-        if len(self.row_buffer["rows"]) > 0:
-            self.pbi.post_table_row(
-                self.row_buffer["rows"],
+    def submit_rows(self, rows_payload):
+        self.collect_done_pushes()
+        # Blocks when MAX_PENDING_PUSHES buffers are already waiting for the network
+        self.pending_pushes_slots.acquire()
+        try:
+            future = self.executor.submit(self.post_rows, rows_payload)
+        except Exception:
+            self.pending_pushes_slots.release()
+            raise
+        future.add_done_callback(lambda done_future: self.pending_pushes_slots.release())
+        self.pending_pushes.append(future)
+
+    def collect_done_pushes(self):
+        while self.pending_pushes and self.pending_pushes[0].done():
+            self.pending_pushes.popleft()
+        if self.push_error is not None:
+            # Sending the queued buffers would leave a hole in the dataset
+            for future in self.pending_pushes:
+                future.cancel()
+            raise self.push_error
+
+    def post_rows(self, rows_payload):
+        if self.push_error is not None:
+            return None
+        try:
+            response = self.pbi.post_table_data(
+                rows_payload.get_data(),
                 self.dsid,
                 self.pbi_table,
                 pbi_group_id=self.pbi_group_id
             )
-        logger.info("[+] Loading complete.")
-        msg = ""
-        msg = msg + "[+] {}".format("="*80) + "\n"
-        msg = msg + "[+] Your Power BI dataset should be available at:" + "\n"
-        msg = msg + "[+] https://app.powerbi.com/groups/me/datasets/{}".format(self.dsid) + "\n"
-        msg = msg + "[+] {}".format("="*80)
+        except Exception as error:
+            self.push_error = error
+            raise
+        self.pushed_rows += len(rows_payload)
+        return response
+
+    def close(self):
+        try:
+            # Every previous buffer must be pushed before the last, partial one
+            wait(self.pending_pushes)
+            self.collect_done_pushes()
+            if len(self.row_buffer) > 0:
+                self.post_rows(self.row_buffer)
+        finally:
+            self.executor.shutdown(wait=True)
+            if self.pbi.throttled_requests > 0:
+                logger.warning("Power BI throttled {} requests (HTTP 429), try a larger buffer size to send fewer pushes".format(
+                    self.pbi.throttled_requests
+                ))
+        # Only reached once every push succeeded
+        logger.info("[+] Loading complete: {} rows sent in {:.1f}s.".format(self.pushed_rows, time.time() - self.start_time))
+        msg = "\n".join([
+            "[+] {}".format("="*80),
+            "[+] Your Power BI dataset should be available at:",
+            "[+] https://app.powerbi.com/groups/me/datasets/{}".format(self.dsid),
+            "[+] {}".format("="*80)
+        ])
         logger.info(msg)
@@ -1,15 +1,64 @@
+import hashlib
 import json
 import requests
 import logging
 import math
-
-
-GROUPS_API = "https://api.powerbi.com/v1.0/myorg/groups"
-DATASETS_API = "https://api.powerbi.com/v1.0/myorg/datasets"
-GROUP_DATASETS_API = "https://api.powerbi.com/v1.0/myorg/groups/{group_id}/datasets"
+import msal
+import threading
+import zlib
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from sys import intern
+except ImportError:
+    def intern(name):
+        # The python 2 builtin rejects unicode, which DSS column names are
+        return name
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+API_ROOT = "https://api.powerbi.com/v1.0/myorg"
+GROUPS_API = API_ROOT + "/groups"
+DATASETS_API = API_ROOT + "/datasets"
+GROUP_DATASETS_API = API_ROOT + "/groups/{group_id}/datasets"
 TABLE_ROWS_API = "{}/{}/tables/{}/rows"
-API_404 = "https://api.powerbi.com/v1.0/myorg/lalala"
+API_404 = API_ROOT + "/lalala"
 DEFAULT_PBI_TABLE = "dss-data"
+# https://docs.microsoft.com/en-us/power-bi/developer/automation/api-rest-api-limitations
+MAX_ROWS_PER_PUSH = 10000
+
+# Rows wire formats. Power BI only accepts JSON, MessagePack is meant for
+#    a relay that receives the rows pushes and forwards them to Power BI
+WIRE_FORMAT_JSON = "json"
+WIRE_FORMAT_MSGPACK = "msgpack"
+WIRE_FORMAT_CONTENT_TYPES = {
+    WIRE_FORMAT_JSON: "application/json",
+    WIRE_FORMAT_MSGPACK: "application/msgpack"
+}
+
+# HTTP connection pooling and retry strategy for the Power BI API session
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+MAX_RETRIES = 5
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUS_FORCELIST = [429, 500, 502, 503, 504]
+TOO_MANY_REQUESTS = 429
+# When rows compression is enabled, rows pushes larger than this are sent gzip compressed
+GZIP_MIN_SIZE = 1024
+GZIP_COMPRESS_LEVEL = 1
+# Credentials authentication
+AUTHORITY = "https://login.microsoftonline.com/organizations"
+POWER_BI_SCOPES = ["https://analysis.windows.net/powerbi/api/.default"]
 
 # Data types mapping DSS => Power BI
 fieldSetterMap = {
@@ -27,6 +76,10 @@ fieldSetterMap = {
     'object':   'String'
 }
 
+# (client_id, client_secret hash) => msal application, each one holding its own in memory token cache
+msal_applications = {}
+msal_applications_lock = threading.Lock()
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO,
                     format='power-bi plugin %(levelname)s - %(message)s')
@@ -35,18 +88,53 @@ logging.basicConfig(level=logging.INFO,
 # Main interactor object
 class PowerBI(object):
 
-    def __init__(self, token):
+    def __init__(self, token, wire_format=WIRE_FORMAT_JSON, rows_relay_url=None, compress_rows=False):
         self.token = token
         self.headers = {
             'Authorization': 'Bearer ' + self.token,
             'Content-Type': 'application/json'
         }
+        self.session = self.build_session()
         self.columns_with_date = None
         self.columns_with_boolean = None
+        self.value_converters = None
+        self.row_encoder = None
+        self.table_rows_urls = {}
+        self.throttled_requests = 0
+        self.throttled_requests_lock = threading.Lock()
+        self.compress_rows = compress_rows
+        self.rows_relay_url = rows_relay_url.rstrip("/") if rows_relay_url else None
+        check_rows_relay_url(self.rows_relay_url)
+        self.wire_format = wire_format or WIRE_FORMAT_JSON
+        if self.wire_format == WIRE_FORMAT_MSGPACK:
+            check_msgpack_wire_format(self.rows_relay_url)
+            self.rows_dumps = msgpack_dumps
+        elif self.wire_format == WIRE_FORMAT_JSON:
+            self.rows_dumps = json_dumps
+        else:
+            raise Exception("Unknown wire format '{}'".format(self.wire_format))
+        self.rows_content_type = WIRE_FORMAT_CONTENT_TYPES[self.wire_format]
+
+    def build_session(self):
+        # One keep-alive session for all calls, so that each rows push
+        #    does not pay for a new TCP + TLS handshake
+        session = requests.Session()
+        session.headers.update(self.headers)
+        retries = Retry(
+            total=MAX_RETRIES,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUS_FORCELIST,
+            raise_on_status=False
+        )
+        session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retries)
+        )
+        return session
 
     def get_datasets(self, pbi_group_id=None):
         endpoint = self.get_datasets_base_url(pbi_group_id=pbi_group_id)
-        response = requests.get(endpoint, headers=self.headers)
+        response = self.session.get(endpoint)
         return response
 
     def get_dataset_by_name(self, name, pbi_group_id=None):
@@ -59,9 +147,18 @@ class PowerBI(object):
                     ret.append(dataset['id'])
         return ret
 
+    def get_first_dataset_id_by_name(self, name, pbi_group_id=None):
+        # Stops at the first dataset matching name, returns None if there is none
+        data = self.get_datasets(pbi_group_id=pbi_group_id)
+        datasets = data.json().get('value') or []
+        for dataset in datasets:
+            if dataset['name'] == name:
+                return dataset['id']
+        return None
+
     def delete_dataset(self, dsid, pbi_group_id=None):
         endpoint = '{}/{}'.format(self.get_datasets_base_url(pbi_group_id=pbi_group_id), dsid)
-        response = requests.delete(endpoint, headers=self.headers)
+        response = self.session.delete(endpoint)
         assert_response_ok(response, while_trying="deleting {}".format(dsid))
         logger.info("[+] Deleted existing Power BI dataset {} (response code: {})...".format(
             dsid, response.status_code
@@ -72,23 +169,18 @@ class PowerBI(object):
         # Empty an existing dataset's content, without deleting the dataset
         #    keeping related reports intact
         response = self._delete(
-            TABLE_ROWS_API.format(
-                self.get_datasets_base_url(pbi_group_id=pbi_group_id),
-                dsid,
-                pbi_table
-            ),
+            self.get_table_rows_url(dsid, pbi_table=pbi_table, pbi_group_id=pbi_group_id),
             fail_on_errors=False
         )
         return response
 
     def create_dataset_from_schema(self, pbi_dataset=None, pbi_table=DEFAULT_PBI_TABLE, pbi_group_id=None, schema=None):
         # Build the Power BI Dataset schema
-        columns = []
-        for column in schema["columns"]:
-            new_column = {}
-            new_column["name"] = column["name"]
-            new_column["dataType"] = fieldSetterMap.get(column["type"], "String")
-            columns.append(new_column)
+        get_data_type = fieldSetterMap.get
+        columns = [
+            {"name": column["name"], "dataType": get_data_type(column["type"], "String")}
+            for column in schema["columns"]
+        ]
         payload = {
             "name": pbi_dataset,
             "defaultMode": "PushStreaming",
@@ -102,7 +194,7 @@ class PowerBI(object):
 
         json_response = self.post(
             self.get_datasets_base_url(pbi_group_id=pbi_group_id),
-            data=json.dumps(payload)
+            data=json_dumps(payload)
         )
         return json_response
 
@@ -110,14 +202,20 @@ class PowerBI(object):
         self.columns_with_date = []
         self.columns_with_boolean = []
         for column in schema["columns"]:
+            # Interned like the exporter's row keys, so lookups match on identity
             if column["type"] == "date":
-                self.columns_with_date.append(column["name"])
+                self.columns_with_date.append(intern(column["name"]))
             if column["type"] == "boolean":
-                self.columns_with_boolean.append(column["name"])
+                self.columns_with_boolean.append(intern(column["name"]))
+        # (column name, converter) pairs applied to each row, in a single pass
+        self.value_converters = tuple(
+            [(column_with_date, date_convertion) for column_with_date in self.columns_with_date] +
+            [(column_with_boolean, boolean_check) for column_with_boolean in self.columns_with_boolean]
+        )
         if (len(self.columns_with_date) > 0) or (len(self.columns_with_boolean) > 0):
-            self.json_filter = self.parse_formattable_values
+            self.row_encoder = self.encode_row
         else:
-            self.json_filter = json.dumps
+            self.row_encoder = self.rows_dumps
 
     def get_group_id_by_name(self, pbi_workspace=None):
         if pbi_workspace is None or pbi_workspace == "My workspace":
@@ -149,18 +247,49 @@ class PowerBI(object):
             ret = GROUP_DATASETS_API.format(group_id=pbi_group_id)
         return ret
 
+    def get_table_rows_url(self, dsid, pbi_table=DEFAULT_PBI_TABLE, pbi_group_id=None, use_relay=False):
+        # Built once per table, as it is needed for every rows push
+        #    use_relay: send to the rows relay if there is one, only for rows pushes
+        cache_key = (dsid, pbi_table, pbi_group_id, use_relay)
+        url = self.table_rows_urls.get(cache_key)
+        if url is None:
+            datasets_base_url = self.get_datasets_base_url(pbi_group_id=pbi_group_id)
+            if use_relay and self.rows_relay_url:
+                datasets_base_url = self.rows_relay_url + datasets_base_url[len(API_ROOT):]
+            url = TABLE_ROWS_API.format(
+                datasets_base_url,
+                dsid,
+                pbi_table
+            )
+            self.table_rows_urls[cache_key] = url
+        return url
+
     def get(self, url, custom_error_messages=None):
-        response = requests.get(url, headers=self.headers)
+        response = self.session.get(url)
         assert_response_ok(response, custom_error_messages=custom_error_messages)
         json_response = response.json()
         return json_response
 
-    def post(self, url, data, fail_on_errors=True):
-        response = requests.post(
+    def post(self, url, data, fail_on_errors=True, content_type=None, compress=False, send_token=True):
+        headers = {}
+        if not send_token:
+            # None removes the session's Authorization header for this request
+            headers['Authorization'] = None
+        if content_type:
+            headers['Content-Type'] = content_type
+        if compress and isinstance(data, (bytes, bytearray)) and len(data) > GZIP_MIN_SIZE:
+            data = gzip_compress(data)
+            headers['Content-Encoding'] = 'gzip'
+        response = self.session.post(
             url,
             data=data,
-            headers=self.headers
+            headers=headers or None
         )
+        if response.status_code == TOO_MANY_REQUESTS:
+            # urllib3 does not retry POST, so throttled pushes reach this point.
+            #    Rows pushes run on the exporter's worker thread too
+            with self.throttled_requests_lock:
+                self.throttled_requests += 1
         assert_response_ok(response, fail_on_errors=fail_on_errors)
         if is_json_response(response):
             return response.json()
@@ -168,10 +297,7 @@ class PowerBI(object):
             return response
 
     def _delete(self, url, fail_on_errors=True):
-        response = requests.delete(
-            url,
-            headers=self.headers
-        )
+        response = self.session.delete(url)
         assert_response_ok(response, fail_on_errors=fail_on_errors)
         if is_json_response(response):
             return response.json()
@@ -179,32 +305,122 @@ class PowerBI(object):
             return response
 
     def post_table_row(self, rows, dsid, pbi_table=DEFAULT_PBI_TABLE, pbi_group_id=None):
-        new_data = self.json_filter(rows)
+        # Same serialization path as the exporter's incremental buffers
+        rows_payload = self.new_rows_payload()
+        for row in rows:
+            rows_payload.append(row)
+        return self.post_table_data(rows_payload.get_data(), dsid, pbi_table=pbi_table, pbi_group_id=pbi_group_id)
+
+    def post_table_data(self, data, dsid, pbi_table=DEFAULT_PBI_TABLE, pbi_group_id=None):
+        # Push rows already serialized in self.wire_format, such as RowsPayload.get_data()
+        #    The Power BI access token is never sent to a rows relay
         response = self.post(
-            TABLE_ROWS_API.format(
-                self.get_datasets_base_url(pbi_group_id=pbi_group_id),
-                dsid,
-                pbi_table
-            ),
-            data=new_data,
-            fail_on_errors=True
+            self.get_table_rows_url(dsid, pbi_table=pbi_table, pbi_group_id=pbi_group_id, use_relay=True),
+            data=data,
+            fail_on_errors=True,
+            content_type=self.rows_content_type,
+            compress=self.compress_rows,
+            send_token=self.rows_relay_url is None
         )
         return response
 
-    def parse_formattable_values(self, rows):
-        ret = []
+    def format_row(self, row):
+        # Convert in place the date and boolean values of a single row
         try:
-            for row in rows:
-                for column_with_date in self.columns_with_date:
-                    date_to_convert = row[column_with_date]
-                    row[column_with_date] = date_convertion(date_to_convert)
-                for column_with_boolean in self.columns_with_boolean:
-                    boolean_to_check = row[column_with_boolean]
-                    row[column_with_boolean] = boolean_check(boolean_to_check)
-                ret.append(row)
+            for column_name, convert in self.value_converters:
+                value_to_convert = row[column_name]
+                row[column_name] = convert(value_to_convert)
         except AttributeError:
-            raise Exception("Date '{}' is not correctly formatted".format(date_to_convert))
-        return json.dumps(ret)
+            # Only date_convertion can raise it, on values without isoformat()
+            raise Exception("Date '{}' is not correctly formatted".format(value_to_convert))
+        return row
+
+    def encode_row(self, row):
+        return self.rows_dumps(self.format_row(row))
+
+    def new_rows_payload(self):
+        # register_formattable_columns must have been called first
+        if self.wire_format == WIRE_FORMAT_MSGPACK:
+            return MsgpackRowsPayload(self.row_encoder)
+        return RowsPayload(self.row_encoder)
+
+
+class RowsPayload(object):
+    """
+      JSON array of rows, serialized incrementally as rows are appended
+      so that a full buffer never holds both the row objects and their JSON.
+    """
+
+    def __init__(self, encode_row):
+        self.encode_row = encode_row
+        self.data = bytearray(b"[")
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, row):
+        if self.count > 0:
+            self.data += b","
+        self.data += self.encode_row(row)
+        self.count += 1
+
+    def get_data(self):
+        # Closes the array and returns the buffer itself rather than a copy,
+        #    nothing should be appended afterwards
+        self.data += b"]"
+        return self.data
+
+
+class MsgpackRowsPayload(RowsPayload):
+    """
+      MessagePack array of rows. Rows are packed one after the other
+      and the array header is only written once the final count is known.
+    """
+
+    def __init__(self, encode_row):
+        self.encode_row = encode_row
+        self.data = bytearray()
+        self.count = 0
+
+    def append(self, row):
+        self.data += self.encode_row(row)
+        self.count += 1
+
+    def get_data(self):
+        # Prepends the header in place rather than building a copy,
+        #    nothing should be appended afterwards
+        self.data[0:0] = msgpack.Packer().pack_array_header(self.count)
+        return self.data
+
+
+def check_rows_relay_url(rows_relay_url):
+    if rows_relay_url and not rows_relay_url.lower().startswith("https://"):
+        raise Exception("The rows relay URL must use https")
+
+
+def check_msgpack_wire_format(rows_relay_url):
+    if msgpack is None:
+        raise Exception("The msgpack package is required to use the MessagePack wire format")
+    if not rows_relay_url:
+        raise Exception("Power BI only accepts JSON rows, the MessagePack wire format requires a rows relay URL")
+
+
+def msgpack_dumps(payload):
+    return msgpack.packb(payload, use_bin_type=True)
+
+
+def json_dumps(payload):
+    # Serialize to compact UTF-8 JSON bytes, with orjson when it is available
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def gzip_compress(data):
+    # zlib with gzip framing, as gzip.compress is not available on python 2
+    compressor = zlib.compressobj(GZIP_COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
 
 
 def date_convertion(pandas_date):
@@ -222,7 +438,8 @@ def boolean_check(pandas_boolean):
 
 
 def is_json_response(response):
-    return response.headers.get('content-type').find("application/json") >= 0
+    # Content-Type can be missing, for instance on some transient 5xx
+    return (response.headers.get('content-type') or '').startswith("application/json")
 
 
 def assert_response_ok(response, while_trying=None, fail_on_errors=True, custom_error_messages=None):
@@ -253,6 +470,8 @@ def get_error_message(response, while_trying=None, custom_error_messages=None):
 
 def extract_error_message_from_response(response):
     ret = ""
+    if not response.content:
+        return ret
     try:
         json_response = response.json()
         ret = get_value_from_path(json_response, ["error", "message"], response.content)
@@ -275,16 +494,30 @@ def generate_access_token(username=None, password=None, client_id=None, client_s
     """
       Call the Azure API's to retrieve an access token to interact with Power BI.
       Requires full credentials to be passed.
+      Tokens are cached by MSAL and silently refreshed from their refresh token.
+      On failure, the returned MSAL response has no access_token but an error_description.
     """
-    data = {
-        "username": username,
-        "password": password,
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "resource": "https://analysis.windows.net/powerbi/api",
-        "grant_type": "password",
-        "scope": "openid"
-    }
-    response = requests.post('https://login.microsoftonline.com/common/oauth2/token', data=data)
-    assert_response_ok(response, while_trying="retrieving access token")
-    return response.json()
+    with msal_applications_lock:
+        application = get_msal_application(client_id, client_secret)
+        response = None
+        accounts = application.get_accounts(username=username)
+        if accounts:
+            response = application.acquire_token_silent(POWER_BI_SCOPES, account=accounts[0])
+        if not response:
+            response = application.acquire_token_by_username_password(username, password, scopes=POWER_BI_SCOPES)
+    return response
+
+
+def get_msal_application(client_id, client_secret):
+    # A rotated secret, or another preset using the same client id, gets its own application
+    secret_hash = hashlib.sha256((client_secret or "").encode("utf-8")).hexdigest()
+    cache_key = (client_id, secret_hash)
+    application = msal_applications.get(cache_key)
+    if application is None:
+        application = msal.ConfidentialClientApplication(
+            client_id,
+            client_credential=client_secret,
+            authority=AUTHORITY
+        )
+        msal_applications[cache_key] = application
+    return application
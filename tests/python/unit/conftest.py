@@ -0,0 +1,18 @@
+import os
+import sys
+import types
+
+PLUGIN_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+sys.path.insert(0, os.path.join(PLUGIN_ROOT, "python-lib"))
+sys.path.insert(0, os.path.join(PLUGIN_ROOT, "python-exporters", "python-both-auth"))
+
+# The dataiku package only exists inside DSS, the exporter just needs its base class
+try:
+    import dataiku.exporter  # noqa: F401
+except ImportError:
+    dataiku_module = types.ModuleType("dataiku")
+    exporter_module = types.ModuleType("dataiku.exporter")
+    exporter_module.Exporter = object
+    dataiku_module.exporter = exporter_module
+    sys.modules["dataiku"] = dataiku_module
+    sys.modules["dataiku.exporter"] = exporter_module
@@ -0,0 +1,158 @@
+import json
+import threading
+
+import pytest
+from unittest.mock import MagicMock, patch
+
+import powerbi
+from exporter import PowerBIExporter
+from powerbi import MAX_ROWS_PER_PUSH
+
+SCHEMA = {
+    "columns": [
+        {"name": "id", "type": "int"},
+        {"name": "name", "type": "string"}
+    ]
+}
+
+
+def build_config(buffer_size):
+    return {
+        "authentication_method": "oauth",
+        "powerbi_connection": {"ms-oauth_credentials": "token"},
+        "dataset": "dataset",
+        "export_method": "append",
+        "buffer_size": buffer_size
+    }
+
+
+def response(status_code=200):
+    ret = MagicMock()
+    ret.status_code = status_code
+    ret.headers = {"content-type": "application/json"}
+    ret.content = b'{"error": {"message": "push failed"}}'
+    ret.json.return_value = {"error": {"message": "push failed"}}
+    return ret
+
+
+@pytest.fixture
+def posted_rows():
+    return []
+
+
+@pytest.fixture
+def session_post(posted_rows):
+    def post(url, data=None, headers=None):
+        posted_rows.append(json.loads(bytes(data)))
+        return response()
+    with patch.object(powerbi.requests.Session, "post", side_effect=post) as mocked_post:
+        yield mocked_post
+
+
+@pytest.fixture
+def open_exporter():
+    def open_exporter(buffer_size):
+        with patch.object(powerbi.PowerBI, "get_first_dataset_id_by_name", return_value="dsid"):
+            exporter = PowerBIExporter(build_config(buffer_size), {})
+            exporter.open(SCHEMA)
+        return exporter
+    return open_exporter
+
+
+@pytest.mark.parametrize("buffer_size, expected", [
+    (100, 100),
+    (None, MAX_ROWS_PER_PUSH),
+    (MAX_ROWS_PER_PUSH * 10, MAX_ROWS_PER_PUSH),
+    (-5, 1)
+])
+def test_buffer_size_is_clamped(buffer_size, expected):
+    assert PowerBIExporter.get_buffer_size_from_config({"buffer_size": buffer_size}) == expected
+
+
+def test_rows_are_pushed_in_order(session_post, posted_rows, open_exporter):
+    exporter = open_exporter(2)
+    for index in range(5):
+        exporter.write_row((float(index), "row {}".format(index)))
+    exporter.close()
+    assert [[row["id"] for row in rows] for rows in posted_rows] == [[0, 1], [2, 3], [4]]
+    assert exporter.pushed_rows == 5
+
+
+def failing_post_after(network):
+    def post(url, data=None, headers=None):
+        network.wait()
+        return response(500)
+    return post
+
+
+def test_close_raises_a_failed_last_push(open_exporter):
+    with patch.object(powerbi.requests.Session, "post", return_value=response(500)):
+        exporter = open_exporter(2)
+        exporter.write_row((1.0, "row"))
+        with pytest.raises(Exception, match="push failed"):
+            exporter.close()
+
+
+def test_failed_push_stops_the_queued_pushes(posted_rows, open_exporter):
+    network = threading.Event()
+
+    def first_post_fails(url, data=None, headers=None):
+        posted_rows.append(json.loads(bytes(data)))
+        if len(posted_rows) == 1:
+            network.wait()
+            return response(500)
+        return response()
+
+    with patch.object(powerbi.requests.Session, "post", side_effect=first_post_fails):
+        exporter = open_exporter(1)
+        # One buffer in flight, the next ones queued behind it
+        for index in range(exporter.MAX_PENDING_PUSHES):
+            exporter.write_row((float(index), "row"))
+        network.set()
+        exporter.pending_pushes[0].exception()
+        with pytest.raises(Exception, match="push failed"):
+            exporter.write_row((4.0, "row"))
+        with pytest.raises(Exception, match="push failed"):
+            exporter.close()
+        assert [[row["id"] for row in rows] for rows in posted_rows] == [[0]]
+        assert exporter.pushed_rows == 0
+
+
+def test_write_row_raises_a_failed_push(open_exporter):
+    network = threading.Event()
+    with patch.object(powerbi.requests.Session, "post", side_effect=failing_post_after(network)):
+        exporter = open_exporter(1)
+        exporter.write_row((1.0, "row"))
+        network.set()
+        exporter.pending_pushes[0].exception()
+        with pytest.raises(Exception, match="push failed"):
+            exporter.write_row((2.0, "row"))
+        # No push may outlive the mocked post
+        exporter.executor.shutdown(wait=True)
+
+
+def test_pending_pushes_are_bounded(open_exporter):
+    network = threading.Event()
+
+    def blocked_post(url, data=None, headers=None):
+        network.wait()
+        return response()
+
+    with patch.object(powerbi.requests.Session, "post", side_effect=blocked_post) as mocked_post:
+        exporter = open_exporter(1)
+
+        def write_rows():
+            for index in range(exporter.MAX_PENDING_PUSHES + 1):
+                exporter.write_row((float(index), "row"))
+
+        writer = threading.Thread(target=write_rows)
+        writer.start()
+        writer.join(timeout=0.5)
+        # The last full buffer waits for a slot, the first ones are still in flight
+        assert writer.is_alive()
+        assert len(exporter.pending_pushes) == exporter.MAX_PENDING_PUSHES
+        network.set()
+        writer.join(timeout=5)
+        assert not writer.is_alive()
+        exporter.close()
+        assert mocked_post.call_count == exporter.MAX_PENDING_PUSHES + 1
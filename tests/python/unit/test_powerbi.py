@@ -0,0 +1,120 @@
+import gzip
+import json
+
+import msgpack
+import pytest
+from unittest.mock import MagicMock
+
+from powerbi import PowerBI, RowsPayload, MsgpackRowsPayload, json_dumps, msgpack_dumps, gzip_compress, GZIP_MIN_SIZE
+
+SCHEMA = {
+    "columns": [
+        {"name": "id", "type": "int"},
+        {"name": "flag", "type": "boolean"},
+        {"name": "day", "type": "date"}
+    ]
+}
+
+
+class FakeDate(object):
+    def __init__(self, iso):
+        self.iso = iso
+
+    def isoformat(self):
+        return self.iso
+
+
+def ok_response():
+    response = MagicMock()
+    response.status_code = 200
+    response.headers = {}
+    response.content = b""
+    return response
+
+
+def test_rows_payload_is_a_json_array():
+    rows_payload = RowsPayload(json_dumps)
+    for index in range(3):
+        rows_payload.append({"id": index})
+    assert len(rows_payload) == 3
+    assert json.loads(bytes(rows_payload.get_data())) == [{"id": 0}, {"id": 1}, {"id": 2}]
+
+
+def test_empty_rows_payload():
+    assert bytes(RowsPayload(json_dumps).get_data()) == b"[]"
+
+
+def test_rows_payload_formats_dates_and_booleans():
+    pbi = PowerBI("token")
+    pbi.register_formattable_columns(SCHEMA)
+    rows_payload = pbi.new_rows_payload()
+    rows_payload.append({"id": 1, "flag": float("nan"), "day": FakeDate("2021-01-01T00:00:00")})
+    rows_payload.append({"id": 2, "flag": True, "day": FakeDate("NaT")})
+    assert json.loads(bytes(rows_payload.get_data())) == [
+        {"id": 1, "flag": None, "day": "2021-01-01T00:00:00"},
+        {"id": 2, "flag": True, "day": None}
+    ]
+
+
+@pytest.mark.parametrize("count, header", [
+    (3, b"\x93"),           # fixarray
+    (20, b"\xdc\x00\x14")   # array 16
+])
+def test_msgpack_rows_payload_array_header(count, header):
+    rows_payload = MsgpackRowsPayload(msgpack_dumps)
+    for index in range(count):
+        rows_payload.append({"id": index})
+    data = bytes(rows_payload.get_data())
+    assert data.startswith(header)
+    assert msgpack.unpackb(data) == [{"id": index} for index in range(count)]
+
+
+def test_gzip_compress_round_trip():
+    data = json_dumps([{"id": index, "name": "row"} for index in range(500)])
+    compressed = gzip_compress(bytearray(data))
+    assert len(compressed) < len(data)
+    assert gzip.decompress(compressed) == data
+
+
+def test_post_compresses_rows_only_when_enabled():
+    for compress_rows, expected_encoding in [(False, None), (True, "gzip")]:
+        pbi = PowerBI("token", compress_rows=compress_rows)
+        pbi.session.post = MagicMock(return_value=ok_response())
+        pbi.post_table_data(bytearray(b"x" * (GZIP_MIN_SIZE + 1)), "dsid")
+        headers = pbi.session.post.call_args[1]["headers"]
+        assert headers.get("Content-Encoding") == expected_encoding
+
+
+def test_table_rows_url_without_relay():
+    pbi = PowerBI("token")
+    assert pbi.get_table_rows_url("dsid", use_relay=True) == "https://api.powerbi.com/v1.0/myorg/datasets/dsid/tables/dss-data/rows"
+
+
+def test_table_rows_url_relay_rewrite():
+    pbi = PowerBI("token", rows_relay_url="https://relay.example.com/pbi/")
+    assert pbi.get_table_rows_url("dsid", pbi_group_id="gid", use_relay=True) == "https://relay.example.com/pbi/groups/gid/datasets/dsid/tables/dss-data/rows"
+    assert pbi.get_table_rows_url("dsid", use_relay=True) == "https://relay.example.com/pbi/datasets/dsid/tables/dss-data/rows"
+    # Emptying a dataset still goes straight to Power BI
+    assert pbi.get_table_rows_url("dsid") == "https://api.powerbi.com/v1.0/myorg/datasets/dsid/tables/dss-data/rows"
+
+
+def test_http_relay_is_refused():
+    with pytest.raises(Exception, match="https"):
+        PowerBI("token", rows_relay_url="http://relay.example.com")
+
+
+def test_relay_push_does_not_send_the_access_token():
+    pbi = PowerBI("token", wire_format="msgpack", rows_relay_url="https://relay.example.com")
+    pbi.session.post = MagicMock(return_value=ok_response())
+    pbi.register_formattable_columns(SCHEMA)
+    pbi.post_table_row([{"id": 1, "flag": True, "day": FakeDate("NaT")}], "dsid")
+    url = pbi.session.post.call_args[0][0]
+    headers = pbi.session.post.call_args[1]["headers"]
+    assert url.startswith("https://relay.example.com/")
+    assert headers["Authorization"] is None
+    assert headers["Content-Type"] == "application/msgpack"
+
+
+def test_msgpack_requires_a_relay():
+    with pytest.raises(Exception, match="relay"):
+        PowerBI("token", wire_format="msgpack")